@@ -1,31 +1,52 @@
 import adsk.core
+import adsk.fusion
 import traceback
 from pathlib import Path
+from collections import deque
 from datetime import datetime
-from typing import NamedTuple, List, Set
+from typing import NamedTuple, Dict, List, Set
 from enum import Enum
 from dataclasses import dataclass
+import functools
 import hashlib
-import re
+import locale
+import logging
+import logging.handlers
+import os
+import sys
 
+logger = logging.getLogger('AllVersionsExporter')
 log_file = None
-log_fh = None
+log_handler = None
 
 handlers = []
 
-def log(*args):
-    print(*args, file=log_fh)
-    log_fh.flush()
-
 def init_directory(name):
     directory = Path(name)
     directory.mkdir(exist_ok=True)
     return directory
 
 def init_logging(directory):
-    global log_file, log_fh
+    global log_file, log_handler
     log_file = directory / '{:%Y_%m_%d_%H_%M}.txt'.format(datetime.now())
-    log_fh = open(log_file, 'w')
+    file_handler = logging.FileHandler(log_file, mode='w', delay=True)
+    file_handler.setFormatter(logging.Formatter('%(message)s'))
+    # we log a lot, so hold records in memory and write them out in batches. errors go out straight away,
+    # and everything left is flushed when the export finishes or fails
+    log_handler = logging.handlers.MemoryHandler(1024, flushLevel=logging.ERROR, target=file_handler)
+    logger.addHandler(log_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+def close_logging():
+    global log_handler
+    if log_handler is None:
+        return
+    file_handler = log_handler.target
+    logger.removeHandler(log_handler)
+    log_handler.close()  # flushes, but doesn't close the target
+    file_handler.close()
+    log_handler = None
 
 class Format(Enum):
     F3D = 'f3d'
@@ -39,7 +60,19 @@ FormatFromName = {x.value: x for x in Format}
 
 DEFAULT_SELECTED_FORMATS = {Format.F3D, Format.STEP}
 
+# (exportManager, design, path) -> export options
+ExportOptionsFromFormat = {
+    Format.F3D: lambda em, design, path: em.createFusionArchiveExportOptions(path),
+    Format.STEP: lambda em, design, path: em.createSTEPExportOptions(path),
+    Format.STL: lambda em, design, path: em.createSTLExportOptions(design.rootComponent, path),
+    Format.IGES: lambda em, design, path: em.createIGESExportOptions(path),
+    Format.SAT: lambda em, design, path: em.createSATExportOptions(path),
+    Format.SMT: lambda em, design, path: em.createSMTExportOptions(path),
+}
+
 class Ctx(NamedTuple):
+    # this is the root of the export. the current output directory is passed around separately,
+    # so that descending into folders and sub-components doesn't have to copy the whole Ctx each time
     folder: Path
     formats: List[Format]
     app: adsk.core.Application
@@ -48,34 +81,42 @@ class Ctx(NamedTuple):
     save_sketches: bool
     save_all_versions: bool
 
-    def extend(self, other):
-        return self._replace(folder=self.folder / other)
-
 class LazyDocument:
     def __init__(self, ctx, file):
         self._ctx = ctx
         self._file = file
         self._document = None
+        self._design = None
 
     def open(self):
         if self._document is not None:
             return
-        log(f'Opening `{self._file.name}`')
+        logger.info('Opening `%s`', self._file.name)
         self._document = self._ctx.app.documents.open(self._file)
         self._document.activate()
+        # every format needs the design, so only do the cast once per document
+        self._design = design_from_document(self._document)
 
         if self._ctx.unhide_all:
-            unhide_all_in_document(self._document)
+            unhide_all_in_component(self._design.rootComponent)
 
     def close(self):
         if self._document is None:
             return
-        log(f'Closing {self._file.name}')
+        logger.info('Closing %s', self._file.name)
         self._document.close(False)  # don't save changes
+        self._document = None
+        self._design = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     @property
     def design(self):
-        return design_from_document(self._document)
+        return self._design
 
     @property
     def rootComponent(self):
@@ -87,88 +128,149 @@ class Counter:
     skipped: int = 0
     errored: int = 0
 
-    def __add__(self, other):
-        return Counter(
-            self.saved + other.saved,
-            self.skipped + other.skipped,
-            self.errored + other.errored,
-        )
-    def __iadd__(self, other):
-        self.saved += other.saved
-        self.skipped += other.skipped
-        self.errored += other.errored
-        return self
+fusion_document_cast = adsk.fusion.FusionDocument.cast
 
 def design_from_document(document: adsk.core.Document):
-    return adsk.fusion.FusionDocument.cast(document).design
-
-def unhide_all_in_document(document: adsk.core.Document):
-    unhide_all_in_component(design_from_document(document).rootComponent)
+    return fusion_document_cast(document).design
 
 def unhide_all_in_component(component):
-    component.isBodiesFolderLightBulbOn = True
-    component.isSketchFolderLightBulbOn = True
-
-    for brep in component.bRepBodies:
-        brep.isLightBulbOn = True
-
-    for body in component.meshBodies:
-        body.isLightBulbOn = True
-
-    # I find the name occurrences very confusing, but apparently that is what a sub-component is called
-    for occurrence in component.occurrences:
-        occurrence.isLightBulbOn = True
-        unhide_all_in_component(occurrence.component)
-
+    # explicit stack rather than recursion, deep assemblies can otherwise hit the recursion limit
+    stack = deque([component])
+    while stack:
+        component = stack.pop()
+        component.isBodiesFolderLightBulbOn = True
+        component.isSketchFolderLightBulbOn = True
+
+        for brep in component.bRepBodies:
+            brep.isLightBulbOn = True
+
+        for body in component.meshBodies:
+            body.isLightBulbOn = True
+
+        # I find the name occurrences very confusing, but apparently that is what a sub-component is called
+        for occurrence in component.occurrences:
+            occurrence.isLightBulbOn = True
+            stack.append(occurrence.component)
+
+# this list of characters is just from trying to rename a file in Explorer (on Windows)
+# I think the actual requirements are per fileystem and will be different on Mac
+# I'm not sure how other unicode chars are handled
+BAD_FILENAME_CHARS = str.maketrans({c: ' ' for c in ':\\/*?<>|'})
+
+# the same names come up over and over (every version, every format), so only do the work once.
+# this also means the bad chars message is only logged the first time we see a name
+@functools.lru_cache(maxsize=None)
 def sanitize_filename(name: str) -> str:
     """
     Remove "bad" characters from a filename. Right now just punctuation that Windows doesn't like
     If any chars are removed, we append _{hash} so that we don't accidentally clobber other files
     since eg `Model 1/2` and `Model 1 2` would otherwise have the same name
     """
-    # this list of characters is just from trying to rename a file in Explorer (on Windows)
-    # I think the actual requirements are per fileystem and will be different on Mac
-    # I'm not sure how other unicode chars are handled
-    with_replacement = re.sub(r'[:\\/*?<>|]', ' ', name)
+    with_replacement = name.translate(BAD_FILENAME_CHARS)
     if name == with_replacement:
         return name
-    log(f'filename `{name}` contained bad chars, replacing by `{with_replacement}`')
+    logger.info('filename `%s` contained bad chars, replacing by `%s`', name, with_replacement)
     hash = hashlib.sha256(name.encode()).hexdigest()[:8]
     return f'{with_replacement}_{hash}'
 
-def export_filename(ctx: Ctx, format: Format, file):
-    sanitized = sanitize_filename(file.name)
-    name = f'{sanitized}_v{file.versionNumber}.{format.value}'
-    return ctx.folder / sanitized / name
+# Windows and macOS filesystems are (usually) case insensitive, so `Part` and `part` are the same file there
+CASE_INSENSITIVE_FS = sys.platform in ('win32', 'darwin')
 
-def export_sketches(ctx, component):
-    counter = Counter()
-    for sketch in component.sketches:
-        output_path = ctx.folder / f'{sanitize_filename(sketch.name)}.dxf'
-        if output_path.exists():
-            log(f'{output_path} already exists, skipping')
-            counter.skipped += 1
-        else:
-            log(f'Exporting sketch {sketch.name} in {component.name} to {output_path}')
-            try:
-                output_path.parent.mkdir(exist_ok=True, parents=True)
-                sketch.saveAsDXF(str(output_path))
-                counter.saved += 1
-            except Exception:
-                log(traceback.format_exc())
-                counter.errored += 1
-
-    for occurrence in component.occurrences:
-        counter += export_sketches(ctx.extend(sanitize_filename(occurrence.name)), occurrence.component)
+def listing_key(name: str) -> str:
+    return name.casefold() if CASE_INSENSITIVE_FS else name
 
-    return counter
-
-def export_file(ctx: Ctx, format: Format, file, doc: LazyDocument) -> Counter:
+# we check for existing output for every (file, version, format), so list each output directory
+# once instead of doing a stat per path. anything we write goes into the cached set via mark_exists
+@functools.lru_cache(maxsize=None)
+def dir_listing(directory: Path) -> Set[str]:
+    try:
+        with os.scandir(directory) as entries:
+            return {listing_key(entry.name) for entry in entries}
+    except FileNotFoundError:
+        return set()
+
+def path_exists(path: Path) -> bool:
+    return listing_key(path.name) in dir_listing(path.parent)
+
+def mark_exists(path: Path):
+    dir_listing(path.parent).add(listing_key(path.name))
+
+# directories we've already created this run, so we only mkdir each of them once
+ensured_dirs: Set[Path] = set()
+
+def ensure_dir(directory: Path):
+    if directory in ensured_dirs:
+        return
+    directory.mkdir(exist_ok=True, parents=True)
+    ensured_dirs.add(directory)
+
+def export_filename(output_dir: Path, format: Format, sanitized: str, version: int):
+    name = f'{sanitized}_v{version}.{format.value}'
+    return output_dir / sanitized / name
+
+def subtree_has_sketches(component, cache: Dict[str, bool]) -> bool:
+    # the same component can show up as many occurrences, so remember the answer per component id.
+    # the cache must only live as long as one document: a later version can add sketches to a
+    # component while keeping its id.
+    # post order with an explicit stack rather than recursion, same as unhide_all_in_component
+    root_id = component.id
+    stack = [(root_id, component, None)]
+    while stack:
+        component_id, sub_component, child_ids = stack.pop()
+        if child_ids is not None:
+            # all the children have been answered by now
+            cache[component_id] = any(cache[child_id] for child_id in child_ids)
+        elif component_id in cache:
+            continue
+        elif sub_component.sketches.count > 0:
+            cache[component_id] = True
+        else:
+            children = [occurrence.component for occurrence in sub_component.occurrences]
+            child_ids = [child.id for child in children]
+            stack.append((component_id, sub_component, child_ids))
+            stack.extend((child_id, child, None) for child_id, child in zip(child_ids, children))
+    return cache[root_id]
+
+def export_sketches(output_dir: Path, component, counter: Counter):
+    # depth first with an explicit stack. components with no sketches anywhere below them are never pushed,
+    # so we don't build output paths for the (usually many) parts that have nothing to export
+    has_sketches = {}
+    if not subtree_has_sketches(component, has_sketches):
+        return
+
+    stack = deque([(output_dir, component)])
+    while stack:
+        output_dir, component = stack.pop()
+
+        for sketch in component.sketches:
+            output_path = output_dir / f'{sanitize_filename(sketch.name)}.dxf'
+            if path_exists(output_path):
+                logger.info('%s already exists, skipping', output_path)
+                counter.skipped += 1
+            else:
+                logger.info('Exporting sketch %s in %s to %s', sketch.name, component.name, output_path)
+                try:
+                    ensure_dir(output_path.parent)
+                    sketch.saveAsDXF(str(output_path))
+                    mark_exists(output_path)
+                    counter.saved += 1
+                except Exception:
+                    logger.error('%s', traceback.format_exc())
+                    counter.errored += 1
+
+        for occurrence in component.occurrences:
+            sub_component = occurrence.component
+            if not subtree_has_sketches(sub_component, has_sketches):
+                continue
+            stack.append((output_dir / sanitize_filename(occurrence.name), sub_component))
+
+def export_file(output_dir: Path, format: Format, sanitized: str, version: int, doc: LazyDocument, counter: Counter):
     # TODO コメントも保存する
-    output_path = export_filename(ctx, format, file)
-    if output_path.exists():
-        log(f'{output_path} already exists, skipping')
-        return Counter(skipped=1)
+    output_path = export_filename(output_dir, format, sanitized, version)
+    if path_exists(output_path):
+        logger.info('%s already exists, skipping', output_path)
+        counter.skipped += 1
+        return
 
     doc.open()
 
@@ -177,128 +279,143 @@ def export_file(ctx: Ctx, format: Format, file, doc: LazyDocument) -> Counter:
     design = doc.design
     em = design.exportManager
 
-    output_path.parent.mkdir(exist_ok=True, parents=True)
-
-    # leaving this ugly, not sure what else there might be to handle per format
-    if format == Format.F3D:
-        options = em.createFusionArchiveExportOptions(str(output_path))
-    elif format == Format.STL:
-        options = em.createSTLExportOptions(design.rootComponent, str(output_path))
-    elif format == Format.STEP:
-        options = em.createSTEPExportOptions(str(output_path))
-    elif format == Format.IGES:
-        options = em.createIGESExportOptions(str(output_path))
-    elif format == Format.SAT:
-        options = em.createSATExportOptions(str(output_path))
-    elif format == Format.SMT:
-        options = em.createSMTExportOptions(str(output_path))
-    else:
+    ensure_dir(output_path.parent)
+
+    create_options = ExportOptionsFromFormat.get(format)
+    if create_options is None:
         raise Exception(f'Got unknown export format {format}')
+    options = create_options(em, design, str(output_path))
 
     em.execute(options)
-    log(f'Saved {output_path}')
-
-    return Counter(saved=1)
-
-def export_metadata(ctx: Ctx, file: adsk.core.DataFile) ->Counter:
-    counter = Counter()
-    sanitized = sanitize_filename(file.name)
+    mark_exists(output_path)
+    logger.info('Saved %s', output_path)
+    counter.saved += 1
+
+# metadata file path -> the `Version: N` lines already in it, so that saving all versions of a file
+# doesn't re-read the whole (growing) metadata file once per version
+metadata_versions: Dict[Path, Set[str]] = {}
+
+def read_metadata_versions(output_path: Path) -> Set[str]:
+    versions = metadata_versions.get(output_path)
+    if versions is None:
+        with open(output_path, 'r') as f:
+            versions = {line.strip() for line in f if line.startswith('Version: ')}
+        metadata_versions[output_path] = versions
+    return versions
+
+def export_metadata(output_dir: Path, sanitized: str, version: int, file: adsk.core.DataFile, counter: Counter):
     name = f'{sanitized}_metadata.txt'
-    output_path = ctx.folder / sanitized / name
-    if not output_path.exists():
-        counter = Counter(saved=1)
-        with open(output_path, 'w'):
-            pass
-        log(f'Created {output_path}')
-
-    with open(output_path, 'r') as f:
-        lines = f.readlines()
-        lines_strip = [line.strip() for line in lines]
-        if f'Version: {file.versionNumber}'.strip() in lines_strip:
-            return counter
-
-    with open(output_path, 'a+') as f:
-        f.write("\n".join((
-            f'Version: {file.versionNumber}',
-            f'\tcreated: {datetime.fromtimestamp(file.dateCreated)}',
-            f'\tdescription: {file.description}\n',
-        )))
-        f.flush()
-        log(f'Updated {output_path}')
-    return counter
-
-def visit_file(ctx: Ctx, file: adsk.core.DataFile) -> Counter:
-    log(f'Visiting file {file.name} v{file.versionNumber} . {file.fileExtension}')
-
-    if file.fileExtension != 'f3d':
-        log(f'file {file.name} has extension {file.fileExtension} which is not currently handled, skipping')
-        return Counter(skipped=1)
-
-    doc = LazyDocument(ctx, file)
-
-    counter = Counter()
-
-    if ctx.save_sketches:
-        doc.open()
-        counter += export_sketches(ctx.extend(sanitize_filename(doc.rootComponent.name)), doc.rootComponent)
+    output_path = output_dir / sanitized / name
+    created = not path_exists(output_path)
+    if created:
+        # nothing to read, the file gets created by the append below
+        metadata_versions[output_path] = set()
+
+    versions = read_metadata_versions(output_path)
+    version_line = f'Version: {version}'
+    if version_line in versions:
+        return
+
+    payload = "\n".join((
+        version_line,
+        f'\tcreated: {datetime.fromtimestamp(file.dateCreated)}',
+        f'\tdescription: {file.description}\n',
+    ))
+    # one small append per version, so skip the buffered file object and just do a single write
+    fd = os.open(output_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        # same encoding open() would have used, so older metadata files stay readable
+        os.write(fd, payload.encode(locale.getpreferredencoding(False)))
+    finally:
+        os.close(fd)
+    versions.add(version_line)
+
+    if created:
+        counter.saved += 1
+        mark_exists(output_path)
+        logger.info('Created %s', output_path)
+    logger.info('Updated %s', output_path)
+
+def visit_file(ctx: Ctx, output_dir: Path, file: adsk.core.DataFile, counter: Counter):
+    # each of these goes back through the api (and maybe the cloud), so only read them once
+    name, version, extension = file.name, file.versionNumber, file.fileExtension
+    logger.info('Visiting file %s v%s . %s', name, version, extension)
+
+    if extension != 'f3d':
+        logger.info('file %s has extension %s which is not currently handled, skipping', name, extension)
+        counter.skipped += 1
+        return
+
+    sanitized = sanitize_filename(name)
+
+    # the document is only opened if something actually needs exporting, and is closed exactly once
+    # even if one of the exports blows up
+    with LazyDocument(ctx, file) as doc:
+        if ctx.save_sketches:
+            doc.open()
+            export_sketches(output_dir / sanitize_filename(doc.rootComponent.name), doc.rootComponent, counter)
+
+        # these have to stay sequential: the Fusion API may only be called from the main thread,
+        # so running the exports (or whole files) on a thread pool isn't an option
+        for format in ctx.formats:
+            try:
+                export_file(output_dir, format, sanitized, version, doc, counter)
+            except Exception:
+                counter.errored += 1
+                logger.error('%s', traceback.format_exc())
 
-    for format in ctx.formats:
         try:
-            counter += export_file(ctx, format, file, doc)
+            export_metadata(output_dir, sanitized, version, file, counter)
         except Exception:
             counter.errored += 1
-            log(traceback.format_exc())
+            logger.error('%s', traceback.format_exc())
 
-    try:
-        counter += export_metadata(ctx, file)
-    except Exception:
-        counter.errored += 1
-        log(traceback.format_exc())
-
-    doc.close()
-    return counter
+def collection_to_list(collection) -> list:
+    # read out the whole collection up front instead of going back through swig for each item
+    return [collection.item(i) for i in range(collection.count)]
 
-def visit_file_wrapper(ctx: Ctx, file: adsk.core.DataFile) -> Counter:
-    log(f'Visiting file {file.name}.{file.fileExtension}, which has {file.versionNumber} versions.')
+def visit_file_wrapper(ctx: Ctx, output_dir: Path, file: adsk.core.DataFile, counter: Counter):
+    logger.info('Visiting file %s.%s, which has %s versions.', file.name, file.fileExtension, file.versionNumber)
 
     if(ctx.save_all_versions):
-        counter = Counter()
         for specificVersionFile in file.versions.asArray():
-            counter += visit_file(ctx, specificVersionFile)
-        return counter
+            visit_file(ctx, output_dir, specificVersionFile, counter)
     else:
-        return visit_file(ctx, file)
+        visit_file(ctx, output_dir, file, counter)
 
 
 
-def visit_folder(ctx: Ctx, folder) -> Counter:
-    log(f'Visiting folder {folder.name}')
+def visit_folder(ctx: Ctx, output_dir: Path, folder, counter: Counter):
+    # breadth first over the whole folder tree, rather than recursing per sub folder
+    queue = deque([(output_dir, folder)])
+    while queue:
+        output_dir, folder = queue.popleft()
+        logger.info('Visiting folder %s', folder.name)
 
-    new_ctx = ctx.extend(sanitize_filename(folder.name))
+        folder_dir = output_dir / sanitize_filename(folder.name)
 
-    counter = Counter()
-
-    for file in folder.dataFiles:
-        try:
-            counter += visit_file_wrapper(new_ctx, file)
-        except Exception:
-            log(f'Got exception visiting file\n{traceback.format_exc()}')
-            counter.errored += 1
-
-    for sub_folder in folder.dataFolders:
-        counter += visit_folder(new_ctx, sub_folder)
+        for file in collection_to_list(folder.dataFiles):
+            try:
+                visit_file_wrapper(ctx, folder_dir, file, counter)
+            except Exception:
+                logger.error('Got exception visiting file\n%s', traceback.format_exc())
+                counter.errored += 1
 
-    return counter
+        queue.extend((folder_dir, sub_folder) for sub_folder in collection_to_list(folder.dataFolders))
 
 def main(ctx: Ctx) -> Counter:
     init_directory(ctx.folder)
     init_logging(ctx.folder)
+    # files may have been changed or deleted since the last run
+    metadata_versions.clear()
+    dir_listing.cache_clear()
+    ensured_dirs.clear()
 
     counter = Counter()
 
     for project in ctx.app.data.dataProjects:
         if project.name in ctx.projects:
-            counter += visit_folder(ctx, project.rootFolder)
+            visit_folder(ctx, ctx.folder, project.rootFolder, counter)
 
     return counter
 
@@ -374,18 +491,18 @@ class ExporterCommandExecuteHandler(adsk.core.CommandEventHandler):
                 f'Encountered {counter.errored} errors',
                 f'Log file is at {log_file}',
                 f'Elapsed time: {end_dt - start_dt}'))
-            log("\n\n========Result========")
-            log(result)
+            logger.info("\n\n========Result========")
+            logger.info(result)
+            log_handler.flush()
             ui.messageBox(result)
 
         except:
             tb = traceback.format_exc()
+            if log_handler is not None:
+                logger.error('Got top level exception\n%s', tb)
             adsk.core.Application.get().userInterface.messageBox(f'Log file is at {log_file}\n{tb}')
-            if log_fh is not None:
-                log(f'Got top level exception\n{tb}')
         finally:
-            if log_fh is not None:
-                log_fh.close()
+            close_logging()
 
 def run(context):
     ui = None